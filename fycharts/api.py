@@ -1,13 +1,24 @@
-from datetime import datetime
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
 import os
+import threading
+import time
 
+import orjson
 import requests
-from fastapi import FastAPI, HTTPException, Query
+from cachetools import LRUCache, TTLCache, cached
+from requests.adapters import HTTPAdapter
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse, Response
 
 from fycharts.compute_dates import defaultListOfDates
+from fycharts.log_config import logger
 
 
-REGION_CODES = {
+REGION_CODES = frozenset({
     "global",
     "ad",
     "ar",
@@ -72,15 +83,36 @@ REGION_CODES = {
     "us",
     "uy",
     "vn",
-}
+})
 
-app = FastAPI(title="fycharts API", version="0.2.0")
+app = FastAPI(
+    title="fycharts API",
+    version="0.2.0",
+    default_response_class=ORJSONResponse,
+)
 
 CHARTS_BASE_URL = os.getenv(
     "SPOTIFY_CHARTS_BASE_URL",
     "https://charts-spotify-com-service.spotify.com/auth/v0/charts",
 )
-CHARTS_TOKEN = os.getenv("SPOTIFY_CHARTS_TOKEN")
+
+# Errors with a fixed detail are built once and re-raised. Raise them via
+# with_traceback(None) so tracebacks don't pile up on the shared instance.
+_ERR_NO_TOKEN = HTTPException(
+    status_code=502,
+    detail=(
+        "Spotify Charts now requires an access token. "
+        "Set SPOTIFY_CHARTS_TOKEN in Fly secrets."
+    ),
+)
+_ERR_TOKEN_EXPIRED = HTTPException(
+    status_code=502,
+    detail="Spotify Charts token expired or invalid. Refresh SPOTIFY_CHARTS_TOKEN.",
+)
+_ERR_END_BEFORE_START = HTTPException(
+    status_code=400,
+    detail="End date must be the same as or after start date.",
+)
 
 ALIAS_TEMPLATES = {
     ("top200", "daily"): "regional-{region}-daily",
@@ -89,10 +121,97 @@ ALIAS_TEMPLATES = {
     ("viral50", "weekly"): "viral-{region}-weekly",
 }
 
+CHART_NAMES = {
+    ("top200", "daily"): "top_200_daily",
+    ("top200", "weekly"): "top_200_weekly",
+    ("viral50", "daily"): "viral_50_daily",
+    ("viral50", "weekly"): "viral_50_weekly",
+}
+
+# Column order of every row returned by extract_entries / the chart routes.
+COLUMNS = (
+    "Position",
+    "Track Name",
+    "Artist",
+    "Streams",
+    "date",
+    "region",
+    "spotify_id",
+)
+
+# Upstream fetches are I/O bound; bounded so we don't hammer Spotify.
+# A single request keeps at most FETCH_PER_REQUEST fetches in the shared
+# pool, so one wide query can't queue ahead of everyone else.
+FETCH_WORKERS = int(os.getenv("SPOTIFY_CHARTS_FETCH_WORKERS", "16"))
+FETCH_PER_REQUEST = int(os.getenv("SPOTIFY_CHARTS_FETCH_PER_REQUEST", "4"))
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+# One pooled session so repeated fetches reuse keep-alive TLS connections.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+# Extracted rows keyed by (alias, date, region); maxsize is a row budget,
+# not an entry count, so memory stays bounded whatever the query width.
+# Historical charts never change, so they outlive "latest", which rolls
+# over as Spotify publishes.
+ROWS_CACHE_SIZE = int(os.getenv("SPOTIFY_CHARTS_ROWS_CACHE_SIZE", "100000"))
+LATEST_ROWS_CACHE_SIZE = int(
+    os.getenv("SPOTIFY_CHARTS_LATEST_ROWS_CACHE_SIZE", "20000")
+)
+_latest_rows_cache = TTLCache(
+    maxsize=LATEST_ROWS_CACHE_SIZE, ttl=6 * 3600, getsizeof=len
+)
+_rows_cache = TTLCache(maxsize=ROWS_CACHE_SIZE, ttl=30 * 24 * 3600, getsizeof=len)
+_rows_cache_lock = threading.Lock()
+
+# Failures a background refresh or prefetch should log and survive:
+# upstream errors, network errors and undecodable JSON.
+_REFRESH_ERRORS = (HTTPException, requests.RequestException, ValueError)
+
+# Serialized response bodies are bounded by total bytes, not entry count.
+RESPONSE_CACHE_BYTES = int(
+    os.getenv("SPOTIFY_CHARTS_RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024))
+)
+
+# Serialized "latest" responses keyed by (chart_key, regions), stored with
+# an expiry and bounded by total body bytes. Stale entries are still served
+# while a refresh runs.
+LATEST_MAX_AGE = 300
+LATEST_CACHE_BYTES = int(
+    os.getenv("SPOTIFY_CHARTS_LATEST_CACHE_BYTES", str(32 * 1024 * 1024))
+)
+_latest_bytes_cache = LRUCache(
+    maxsize=LATEST_CACHE_BYTES, getsizeof=lambda entry: len(entry[0])
+)
+_latest_refreshing = set()
+_latest_lock = threading.Lock()
+
+
+def _pack_ymd(value):
+    # Fixed-position YYYY-MM-DD packed as a sortable int (YYYYMMDD), so
+    # build_dates only ever compares and bisects plain ints. No checks:
+    # only for strings already known to be valid dates.
+    return int(value[0:4]) * 10000 + int(value[5:7]) * 100 + int(value[8:10])
+
+
+def _parse_ymd(value):
+    # int() alone would accept signs, underscores and impossible days.
+    year, month, day = value[0:4], value[5:7], value[8:10]
+    if (
+        len(value) != 10
+        or value[4] != "-"
+        or value[7] != "-"
+        or not value.isascii()
+        or not (year.isdigit() and month.isdigit() and day.isdigit())
+    ):
+        raise ValueError(f"Expected YYYY-MM-DD, got '{value}'.")
+    datetime.date(int(year), int(month), int(day))
+    return _pack_ymd(value)
+
 
 def parse_date(value, param_name):
     try:
-        return datetime.strptime(value, "%Y-%m-%d")
+        return _parse_ymd(value)
     except ValueError as exc:
         raise HTTPException(
             status_code=400,
@@ -100,27 +219,32 @@ def parse_date(value, param_name):
         ) from exc
 
 
-def build_dates(start, end, is_weekly, is_viral, latest_only_if_unset=False):
+@functools.lru_cache(maxsize=8)
+def _valid_dates(is_weekly, is_viral, cache_day):
+    # cache_day only keys the cache so entries roll over at midnight.
     valid_dates = defaultListOfDates(is_weekly, is_viral)
-    valid_date_map = {
-        datetime.strptime(date_str, "%Y-%m-%d"): date_str for date_str in valid_dates
-    }
-    valid_date_list = sorted(valid_date_map.keys())
+    valid_date_map = {_pack_ymd(date_str): date_str for date_str in valid_dates}
+    valid_date_ordinals = sorted(valid_date_map.keys())
+    valid_date_strs = [valid_date_map[ordinal] for ordinal in valid_date_ordinals]
+    return valid_date_map, valid_date_ordinals, valid_date_strs
+
+
+def build_dates(start, end, is_weekly, is_viral, latest_only_if_unset=False):
+    valid_date_map, valid_date_ordinals, valid_date_strs = _valid_dates(
+        is_weekly, is_viral, datetime.date.today().toordinal()
+    )
 
     if start is None and end is None and latest_only_if_unset:
         return ["latest"]
     elif start is None:
-        start_dt = valid_date_list[0]
+        start_ord = valid_date_ordinals[0]
     else:
-        start_dt = parse_date(start, "start")
-        if start_dt < valid_date_list[0]:
-            start_dt = valid_date_list[0]
-        elif is_weekly and start_dt not in valid_date_map:
-            suggestions = [
-                valid_date_map[date_dt]
-                for date_dt in valid_date_list
-                if date_dt >= start_dt
-            ][:5]
+        start_ord = parse_date(start, "start")
+        if start_ord < valid_date_ordinals[0]:
+            start_ord = valid_date_ordinals[0]
+        elif is_weekly and start_ord not in valid_date_map:
+            lo = bisect.bisect_left(valid_date_ordinals, start_ord)
+            suggestions = valid_date_strs[lo:lo + 5]
             raise HTTPException(
                 status_code=400,
                 detail=(
@@ -131,71 +255,59 @@ def build_dates(start, end, is_weekly, is_viral, latest_only_if_unset=False):
 
     if end is None:
         if start is None and latest_only_if_unset:
-            end_dt = valid_date_list[-1]
+            end_ord = valid_date_ordinals[-1]
         else:
-            end_dt = valid_date_list[-1]
+            end_ord = valid_date_ordinals[-1]
     else:
-        end_dt = parse_date(end, "end")
-        if end_dt > valid_date_list[-1]:
-            end_dt = valid_date_list[-1]
+        end_ord = parse_date(end, "end")
+        if end_ord > valid_date_ordinals[-1]:
+            end_ord = valid_date_ordinals[-1]
 
-    if end_dt < start_dt:
-        raise HTTPException(
-            status_code=400,
-            detail="End date must be the same as or after start date.",
-        )
+    if end_ord < start_ord:
+        raise _ERR_END_BEFORE_START.with_traceback(None)
 
-    return [
-        valid_date_map[date_dt]
-        for date_dt in valid_date_list
-        if start_dt <= date_dt <= end_dt
-    ]
+    lo = bisect.bisect_left(valid_date_ordinals, start_ord)
+    hi = bisect.bisect_right(valid_date_ordinals, end_ord)
+    return valid_date_strs[lo:hi]
 
 
 def normalize_regions(regions):
     if not regions:
         return ["global"]
-    invalid = [region for region in regions if region not in REGION_CODES]
+    invalid = set(regions).difference(REGION_CODES)
     if invalid:
         raise HTTPException(
             status_code=400,
-            detail=f"Unsupported region(s): {', '.join(invalid)}.",
+            detail=f"Unsupported region(s): {', '.join(sorted(invalid))}.",
         )
     return regions
 
 
 def parse_spotify_id(uri):
-    if not uri or ":" not in uri:
+    if not uri:
         return None
-    parts = uri.split(":")
-    return parts[-1] if len(parts) >= 3 else None
-
-
-def require_token():
-    if CHARTS_TOKEN:
-        return CHARTS_TOKEN
-    raise HTTPException(
-        status_code=502,
-        detail=(
-            "Spotify Charts now requires an access token. "
-            "Set SPOTIFY_CHARTS_TOKEN in Fly secrets."
-        ),
-    )
+    # "spotify:track:ID" -> "ID", without splitting the whole URI.
+    idx = uri.rfind(":")
+    if idx < 0 or uri.count(":", 0, idx) < 1:
+        return None
+    return uri[idx + 1:]
+
+
+@functools.lru_cache(maxsize=1)
+def _auth_headers():
+    # Read the token once; a missing token raises and so is never cached.
+    # Fly restarts the machine when secrets change, so no reload is needed.
+    token = os.getenv("SPOTIFY_CHARTS_TOKEN")
+    if not token:
+        raise _ERR_NO_TOKEN.with_traceback(None)
+    return {"Authorization": f"Bearer {token}"}
 
 
 def fetch_chart_entries(alias, date):
-    token = require_token()
     url = f"{CHARTS_BASE_URL}/{alias}/{date}"
-    response = requests.get(
-        url,
-        headers={"Authorization": f"Bearer {token}"},
-        timeout=15,
-    )
+    response = _session.get(url, headers=_auth_headers(), timeout=15)
     if response.status_code == 401:
-        raise HTTPException(
-            status_code=502,
-            detail="Spotify Charts token expired or invalid. Refresh SPOTIFY_CHARTS_TOKEN.",
-        )
+        raise _ERR_TOKEN_EXPIRED.with_traceback(None)
     if response.status_code >= 400:
         raise HTTPException(
             status_code=502,
@@ -205,11 +317,16 @@ def fetch_chart_entries(alias, date):
     return payload
 
 
+@functools.lru_cache(maxsize=512)
 def normalize_alias(chart_key, region):
     template = ALIAS_TEMPLATES[chart_key]
     return template.format(region=region.lower())
 
 
+# Shared stand-in for missing sub-objects; never mutated.
+_EMPTY = {}
+
+
 def extract_entries(payload, region_override=None):
     display = payload.get("displayChart", {})
     chart_date = display.get("date") or payload.get("date")
@@ -221,46 +338,90 @@ def extract_entries(payload, region_override=None):
     )
 
     entries = []
-    for entry in payload.get("entries", []):
-        if entry.get("missingRequiredFields"):
+    append = entries.append
+    get = dict.get
+    for entry in payload.get("entries") or ():
+        if get(entry, "missingRequiredFields"):
             continue
-        chart_data = entry.get("chartEntryData", {})
-        track_meta = entry.get("trackMetadata") or {}
-        artists = track_meta.get("artists") or []
+        chart_data = get(entry, "chartEntryData") or _EMPTY
+        track_meta = get(entry, "trackMetadata") or _EMPTY
         artist_names = ", ".join(
-            [artist.get("name", "") for artist in artists if artist.get("name")]
+            artist["name"]
+            for artist in get(track_meta, "artists") or ()
+            if get(artist, "name")
         )
-        rank_metric = chart_data.get("rankingMetric") or {}
+        rank_metric = get(chart_data, "rankingMetric") or _EMPTY
         streams = None
-        if rank_metric.get("type") == "STREAMS":
-            streams = rank_metric.get("value")
-
-        entries.append(
-            {
-                "Position": chart_data.get("currentRank"),
-                "Track Name": track_meta.get("trackName"),
-                "Artist": artist_names,
-                "Streams": streams,
-                "date": chart_date,
-                "region": region,
-                "spotify_id": parse_spotify_id(track_meta.get("trackUri")),
-            }
+        if get(rank_metric, "type") == "STREAMS":
+            streams = get(rank_metric, "value")
+
+        append(
+            (
+                get(chart_data, "currentRank"),
+                get(track_meta, "trackName"),
+                artist_names,
+                streams,
+                chart_date,
+                region,
+                parse_spotify_id(get(track_meta, "trackUri")),
+            )
         )
     return entries
 
 
-def fetch_chart(chart_key, dates, regions):
+def fetch_chart_rows(chart_key, date, region, use_cache=True):
+    alias = normalize_alias(chart_key, region)
+    cache = _latest_rows_cache if date == "latest" else _rows_cache
+    key = (alias, date, region)
+    if use_cache:
+        with _rows_cache_lock:
+            hit = cache.get(key)
+        if hit is not None:
+            return hit
+
+    rows = tuple(
+        extract_entries(fetch_chart_entries(alias, date), region_override=region)
+    )
+    # Don't pin empty charts: the date may simply not be published yet.
+    if rows:
+        with _rows_cache_lock:
+            try:
+                cache[key] = rows
+            except ValueError:
+                pass  # larger than the whole budget; just don't cache it
+    return rows
+
+
+def fetch_chart(chart_key, dates, regions, use_cache=True):
     output = []
     misses = []
-    for date in dates:
-        for region in regions:
-            alias = normalize_alias(chart_key, region)
-            payload = fetch_chart_entries(alias, date)
-            entries = extract_entries(payload, region_override=region)
+    pairs = ((date, region) for date in dates for region in regions)
+    pending = deque()
+
+    def submit_next():
+        pair = next(pairs, None)
+        if pair is not None:
+            future = _fetch_pool.submit(
+                fetch_chart_rows, chart_key, *pair, use_cache
+            )
+            pending.append((pair, future))
+
+    for _ in range(FETCH_PER_REQUEST):
+        submit_next()
+    try:
+        while pending:
+            (date, region), future = pending.popleft()
+            entries = future.result()
+            submit_next()
             if not entries:
                 misses.append(f"{date}/{region}")
                 continue
             output.extend(entries)
+    except BaseException:
+        # e.g. a bad token: don't keep sending the rest to Spotify.
+        for _, future in pending:
+            future.cancel()
+        raise
     if not output:
         detail = "No chart data returned for requested dates/regions."
         if misses:
@@ -273,54 +434,166 @@ def fetch_chart(chart_key, dates, regions):
     return output
 
 
+def render_chart(chart_key, dates, regions, use_cache=True):
+    rows = fetch_chart(chart_key, dates, regions, use_cache=use_cache)
+    return orjson.dumps(
+        {"chart": CHART_NAMES[chart_key], "columns": COLUMNS, "rows": rows}
+    )
+
+
+@cached(
+    TTLCache(maxsize=RESPONSE_CACHE_BYTES, ttl=3600, getsizeof=len),
+    lock=threading.Lock(),
+)
+def _cached_fetch(chart_key, dates, regions):
+    # Whole responses, already serialized, keyed on hashable tuples. Bodies
+    # bigger than the whole budget are returned but not cached.
+    return render_chart(chart_key, dates, regions)
+
+
+def refresh_latest(chart_key, regions, use_cache=True):
+    content = render_chart(chart_key, ("latest",), regions, use_cache=use_cache)
+    with _latest_lock:
+        try:
+            _latest_bytes_cache[chart_key, regions] = (
+                content,
+                time.monotonic() + LATEST_MAX_AGE,
+            )
+        except ValueError:
+            pass  # larger than the whole budget; serve it uncached
+    return content
+
+
+def _refresh_latest_quietly(chart_key, regions):
+    try:
+        # Skip the row caches; they would hand back the same "latest"
+        # chart we are trying to refresh.
+        refresh_latest(chart_key, regions, use_cache=False)
+    except _REFRESH_ERRORS as exc:
+        # Keep serving the stale copy until a refresh succeeds.
+        logger.warning(f"Refreshing latest {chart_key} {regions} failed: {exc!r}")
+    finally:
+        with _latest_lock:
+            _latest_refreshing.discard((chart_key, regions))
+
+
+def latest_response(chart_key, regions, background_tasks):
+    key = (chart_key, tuple(regions))
+    with _latest_lock:
+        hit = _latest_bytes_cache.get(key)
+        refresh = (
+            hit is not None
+            and hit[1] <= time.monotonic()
+            and key not in _latest_refreshing
+        )
+        if refresh:
+            _latest_refreshing.add(key)
+
+    if hit is None:
+        content = refresh_latest(*key)
+    else:
+        content = hit[0]
+        if refresh:
+            background_tasks.add_task(_refresh_latest_quietly, *key)
+
+    return Response(
+        content=content,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={LATEST_MAX_AGE}"},
+    )
+
+
+def _prefetch_latest():
+    for chart_key in ALIAS_TEMPLATES:
+        try:
+            refresh_latest(chart_key, ("global",))
+        except _REFRESH_ERRORS as exc:
+            # Upstream unavailable; the first request will retry.
+            logger.warning(f"Prefetching latest {chart_key} failed: {exc!r}")
+
+
+@app.on_event("startup")
+def warm_caches():
+    cache_day = datetime.date.today().toordinal()
+    for is_weekly in (False, True):
+        for is_viral in (False, True):
+            _valid_dates(is_weekly, is_viral, cache_day)
+    try:
+        _auth_headers()
+    except HTTPException:
+        return  # no token yet; chart requests will report it
+    # Off the startup path so a slow upstream can't delay boot.
+    threading.Thread(target=_prefetch_latest, daemon=True).start()
+
+
+def chart_response(chart_key, dates, regions, background_tasks):
+    if dates == ["latest"]:
+        return latest_response(chart_key, regions, background_tasks)
+    content = _cached_fetch(chart_key, tuple(dates), tuple(regions))
+    return Response(content=content, media_type="application/json")
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
 
-@app.get("/charts/top200/daily")
+@app.get("/charts/top200/daily", response_model=None)
 def top200_daily(
+    background_tasks: BackgroundTasks,
     start: str | None = None,
     end: str | None = None,
     region: list[str] | None = Query(default=None),
 ):
     dates = build_dates(start, end, is_weekly=False, is_viral=False, latest_only_if_unset=True)
     regions = normalize_regions(region)
-    data = fetch_chart(("top200", "daily"), dates, regions)
-    return {"chart": "top_200_daily", "data": data}
+    return chart_response(("top200", "daily"), dates, regions, background_tasks)
 
 
-@app.get("/charts/top200/weekly")
+@app.get("/charts/top200/weekly", response_model=None)
 def top200_weekly(
+    background_tasks: BackgroundTasks,
     start: str | None = None,
     end: str | None = None,
     region: list[str] | None = Query(default=None),
 ):
     dates = build_dates(start, end, is_weekly=True, is_viral=False, latest_only_if_unset=True)
     regions = normalize_regions(region)
-    data = fetch_chart(("top200", "weekly"), dates, regions)
-    return {"chart": "top_200_weekly", "data": data}
+    return chart_response(("top200", "weekly"), dates, regions, background_tasks)
 
 
-@app.get("/charts/viral50/daily")
+@app.get("/charts/viral50/daily", response_model=None)
 def viral50_daily(
+    background_tasks: BackgroundTasks,
     start: str | None = None,
     end: str | None = None,
     region: list[str] | None = Query(default=None),
 ):
     dates = build_dates(start, end, is_weekly=False, is_viral=True, latest_only_if_unset=True)
     regions = normalize_regions(region)
-    data = fetch_chart(("viral50", "daily"), dates, regions)
-    return {"chart": "viral_50_daily", "data": data}
+    return chart_response(("viral50", "daily"), dates, regions, background_tasks)
 
 
-@app.get("/charts/viral50/weekly")
+@app.get("/charts/viral50/weekly", response_model=None)
 def viral50_weekly(
+    background_tasks: BackgroundTasks,
     start: str | None = None,
     end: str | None = None,
     region: list[str] | None = Query(default=None),
 ):
     dates = build_dates(start, end, is_weekly=True, is_viral=True, latest_only_if_unset=True)
     regions = normalize_regions(region)
-    data = fetch_chart(("viral50", "weekly"), dates, regions)
-    return {"chart": "viral_50_weekly", "data": data}
+    return chart_response(("viral50", "weekly"), dates, regions, background_tasks)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "fycharts.api:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )